@@ -1,331 +1,900 @@
 #!/bin/env python3
 
-import argparse
+import functools
+import json
 import os
+import re
 import sys
-from abc import ABC, abstractmethod
 from base64 import b64decode
+from importlib.util import find_spec
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Callable, Protocol
 
-import requests
-import yaml
+if TYPE_CHECKING:
+    import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class Database(ABC):
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+if orjson is not None:
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+if msgspec is not None:
+
+    class EntityKey(msgspec.Struct, frozen=True):
+        kind: str
+        id: int
+
+    class Entity(msgspec.Struct, frozen=True):
+        key: EntityKey
+        properties: dict
+
+    def make_entity(kind, id, properties):
+        return Entity(EntityKey(kind, id), properties)
+
+    to_builtins = msgspec.to_builtins
+
+else:
+
+    def make_entity(kind, id, properties):
+        return {"key": {"kind": kind, "id": id}, "properties": properties}
+
+    def to_builtins(obj):
+        return obj
+
+
+# Output documents may hold Entity structs, so msgspec takes precedence when present
+if msgspec is not None:
+
+    def json_dumps_pretty(obj):
+        return msgspec.json.format(msgspec.json.encode(obj), indent=2)
+
+elif orjson is not None:
+
+    def json_dumps_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+else:
+
+    def json_dumps_pretty(obj):
+        return json.dumps(obj, indent=2).encode("utf-8")
+
+
+# Bytes read from the socket per parser step when streaming responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# aiohttp is slow to import, so only check that it is installed up front
+HAS_AIOHTTP = find_spec("aiohttp") is not None
+
+# runQuery body for a GQL query, pre-serialized around the JSON-encoded query string
+_GQL_HEAD = b'{"gqlQuery":{"allowLiterals":true,"queryString":'
+_GQL_TAIL = b"}}"
+
+_COMMENT_RE = re.compile(r"(?m)^--[^\n]*(?:\n|\Z)")
+_OPTION_RE = re.compile(r"(?m)^-- (yq|jq):(.*)$")
+
+
+def gql_body(query_string):
+    return _GQL_HEAD + json_dumps(query_string) + _GQL_TAIL
+
+
+def write_stdout(*chunks):
+    # Flush pending print() output so text and binary writes stay in order
+    sys.stdout.flush()
+    sys.stdout.buffer.writelines(chunks)
+
+
+def dump_yaml(data):
+    import yaml
+
+    try:
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+
+    sys.stdout.flush()
+    yaml.dump_all(
+        [data],
+        stream=sys.stdout.buffer,
+        Dumper=SafeDumper,
+        encoding="utf-8",
+        sort_keys=False,
+    )
+    sys.stdout.buffer.write(b"\n")
+
+
+# Defaults live outside Datastore since its __slots__ reuse these names
+DATASTORE_CONFIG = {
+    "DATASTORE_DATASET": os.getenv("DATASTORE_DATASET", "test"),
+    "DATASTORE_HOST": os.getenv("DATASTORE_HOST", "http://localhost:8081"),
+    "DATASTORE_EMULATOR_HOST": os.getenv("DATASTORE_EMULATOR_HOST", "localhost:8081"),
+    "DATASTORE_EMULATOR_HOST_PATH": os.getenv(
+        "DATASTORE_EMULATOR_HOST_PATH", "localhost:8081/datastore"
+    ),
+    "DATASTORE_PROJECT_ID": os.getenv("DATASTORE_PROJECT_ID", "test"),
+}
+
+
+class Database(Protocol):
     """
-    Abstract class for database
+    Interface for database clients, met structurally by Datastore and DatastoreGrpc
     """
 
-    @abstractmethod
+    def __enter__(self):
+        ...
+
+    def __exit__(self, *exc):
+        ...
+
+    def close(self):
+        ...
+
     def test_connection(self, *args, **kwargs):
         ...
 
-    @abstractmethod
     def query(self, *args, **kwargs):
         ...
 
-    @abstractmethod
     def get(self, *args, **kwargs):
         ...
 
+    def list(self, *args, **kwargs):
+        ...
 
-class Datastore(Database):
-    DATASTORE_DATASET = os.getenv("DATASTORE_DATASET", "test")
-    DATASTORE_HOST = os.getenv("DATASTORE_HOST", "http://localhost:8081")
-    DATASTORE_EMULATOR_HOST = os.getenv("DATASTORE_EMULATOR_HOST", "localhost:8081")
-    DATASTORE_EMULATOR_HOST_PATH = os.getenv(
-        "DATASTORE_EMULATOR_HOST_PATH", "localhost:8081/datastore"
-    )
-    DATASTORE_PROJECT_ID = os.getenv("DATASTORE_PROJECT_ID", "test")
+    def get_scheme(self, *args, **kwargs):
+        ...
 
-    def __init__(
-        self,
-        DATASTORE_DATASET=None,
-        DATASTORE_HOST=None,
-        DATASTORE_EMULATOR_HOST=None,
-        DATASTORE_EMULATOR_HOST_PATH=None,
-        DATASTORE_PROJECT_ID=None,
-    ):
-        self.DATASTORE_DATASET = DATASTORE_DATASET or self.DATASTORE_DATASET
-        self.DATASTORE_HOST = DATASTORE_HOST or self.DATASTORE_HOST
-        self.DATASTORE_EMULATOR_HOST = (
-            DATASTORE_EMULATOR_HOST or self.DATASTORE_EMULATOR_HOST
-        )
-        self.DATASTORE_EMULATOR_HOST_PATH = (
-            DATASTORE_EMULATOR_HOST_PATH or self.DATASTORE_EMULATOR_HOST_PATH
-        )
-        self.DATASTORE_PROJECT_ID = DATASTORE_PROJECT_ID or self.DATASTORE_PROJECT_ID
+    def getKinds(self):
+        ...
+
+
+class BaseDatastore:
+    """
+    Scheme building and output shared by the Datastore transports
+    """
+
+    __slots__ = ("DATASTORE_PROJECT_ID", "_scheme_cache")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def get_scheme(self, kind):
-        response = requests.post(
-            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery",
-            json={
-                "gqlQuery": {
-                    "queryString": f"SELECT * FROM {kind} LIMIT 100",
-                    "allowLiterals": True,
-                }
-            },
+        if self._scheme_cache is not None and kind in self._scheme_cache:
+            return self._scheme_cache[kind]
+
+        scheme = self.generate_scheme(
+            self._query_entity_results(f"SELECT * FROM {kind} LIMIT 100")
         )
-        if response.status_code == 200:
-            return self.generate_scheme(response.json())
+
+        if self._scheme_cache is not None:
+            self._scheme_cache[kind] = scheme
+        return scheme
+
+    def invalidate_scheme(self, kind=None):
+        if self._scheme_cache is None:
+            return
+        if kind is None:
+            self._scheme_cache.clear()
         else:
-            raise Exception("Error:", response.status_code, response.text)
+            self._scheme_cache.pop(kind, None)
 
-    def generate_scheme(self, data):
-        scheme = {}
-        c = 0
-        for _entity in data.get("batch", {}).get("entityResults", []):
-            c += 1
+    def generate_scheme(self, entity_results):
+        scheme, _ = self._build_scheme_and_entities(entity_results, style=None)
+        return scheme
 
+    def _build_scheme_and_entities(self, entity_results, style="scheme"):
+        """
+        Build the scheme and, for style "scheme", the entity list in a single pass
+        """
+        scheme, entities = {}, []
+        for _entity in entity_results:
             entity = _entity.get("entity", {})
 
             kind = entity["key"]["path"][0]["kind"]
-            if scheme.get(kind) is None:
-                scheme[kind] = {}
+            props = scheme.setdefault(kind, {})
 
+            # The first non-null value type seen for a property wins
             for property, opt in entity.get("properties", {}).items():
-                if scheme[kind].get(property) is None:
-                    scheme[kind][property] = set()
+                if props.get(property) is not None:
+                    continue
+                props[property] = None
                 for value in opt:
-                    if (
-                        value.replace("Value", "") != "null"
-                        and value != "excludeFromIndexes"
-                    ):
-                        scheme[kind][property].add(value.replace("Value", ""))
-
-        for kind, properties in scheme.items():
-            for property, values in properties.items():
-                if len(values) >= 1:
-                    scheme[kind][property] = values.pop()
-                else:
-                    scheme[kind][property] = None
+                    if value == "excludeFromIndexes":
+                        continue
+                    value_type = value[:-5] if value.endswith("Value") else value
+                    if value_type != "null":
+                        props[property] = value_type
+                        break
 
-        return scheme
+            if style == "scheme":
+                entities.append(
+                    make_entity(
+                        kind,
+                        int(entity["key"]["path"][0]["id"]),
+                        self._parse_properties(entity.get("properties", {})),
+                    )
+                )
+
+        return scheme, entities
 
     def _parse_properties(self, properties):
         for property, opt in properties.items():
-            properties[property] = None
             for k, v in opt.items():
-                if "Value" in k:
-                    if k == "blobValue":
-                        properties[property] = b64decode(v).decode("utf-8")
-                        break
-                    else:
-                        properties[property] = v
-                        break
+                if not k.endswith("Value"):
+                    continue
+                if k == "blobValue":
+                    properties[property] = b64decode(v).decode("utf-8", "replace")
+                else:
+                    properties[property] = v
+                break
+            else:
+                properties[property] = None
         return properties
 
-    def format_response(
-        self, response: requests.Response, format="yaml", style="scheme"
+    def _dump_entities(self, entity_results, format="yaml", style="scheme"):
+        scheme, entities = self._build_scheme_and_entities(entity_results, style)
+        output_data = {
+            "scheme": scheme,
+            "entities": entities,
+        }
+
+        if format == "json":
+            write_stdout(json_dumps_pretty(output_data), b"\n")
+        else:
+            dump_yaml(to_builtins(output_data))
+
+    def _extract_query(self, text):
+        opts = {}
+        for key, value in _OPTION_RE.findall(text):
+            opts[key] = value.strip()
+        return _COMMENT_RE.sub("", text), opts
+
+    @classmethod
+    def config(cls) -> dict:
+        return dict(DATASTORE_CONFIG)
+
+
+class Datastore(BaseDatastore):
+    __slots__ = (
+        "DATASTORE_DATASET",
+        "DATASTORE_HOST",
+        "DATASTORE_EMULATOR_HOST",
+        "DATASTORE_EMULATOR_HOST_PATH",
+        "session",
+        "_run_query_url",
+    )
+
+    def __init__(
+        self,
+        DATASTORE_DATASET=None,
+        DATASTORE_HOST=None,
+        DATASTORE_EMULATOR_HOST=None,
+        DATASTORE_EMULATOR_HOST_PATH=None,
+        DATASTORE_PROJECT_ID=None,
+        scheme_cache=True,
     ):
-        if response.status_code == 200:
-            data = response.json()
-            output_data = {
-                "scheme": self.generate_scheme(data),
-                "entities": [],
-            }
+        self.DATASTORE_DATASET = (
+            DATASTORE_DATASET or DATASTORE_CONFIG["DATASTORE_DATASET"]
+        )
+        self.DATASTORE_HOST = DATASTORE_HOST or DATASTORE_CONFIG["DATASTORE_HOST"]
+        self.DATASTORE_EMULATOR_HOST = (
+            DATASTORE_EMULATOR_HOST or DATASTORE_CONFIG["DATASTORE_EMULATOR_HOST"]
+        )
+        self.DATASTORE_EMULATOR_HOST_PATH = (
+            DATASTORE_EMULATOR_HOST_PATH
+            or DATASTORE_CONFIG["DATASTORE_EMULATOR_HOST_PATH"]
+        )
+        self.DATASTORE_PROJECT_ID = (
+            DATASTORE_PROJECT_ID or DATASTORE_CONFIG["DATASTORE_PROJECT_ID"]
+        )
 
-            if style == "scheme":
-                for _entity in data.get("batch", {}).get("entityResults", []):
-                    entity = _entity.get("entity", {})
-                    kind = entity["key"]["path"][0]["kind"]
-                    entity_to_append = {
-                        "key": {
-                            "kind": kind,
-                            "id": int(entity["key"]["path"][0]["id"]),
-                        },
-                        "properties": entity.get("properties", {}),
-                    }
-                    entity_to_append["properties"] = self._parse_properties(
-                        entity_to_append["properties"]
-                    )
-                    output_data["entities"].append(entity_to_append)
+        self._run_query_url = (
+            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery"
+        )
 
-            if format == "yaml":
-                # print(yaml.dump(data, sort_keys=False))
-                print(yaml.dump(output_data))
-            elif format == "json":
-                print(data)
-            else:
-                print(response.text)
-
-    def get(self, kind, id):
-        response = requests.post(
-            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery",
-            json={
-                "gqlQuery": {
-                    "queryString": f"SELECT * FROM {kind} WHERE __key__ HAS ANCESTOR KEY({kind}, {id})",
-                    "allowLiterals": True,
-                }
-            },
+        self.session = self._open_session()
+
+        # Schemes rarely change within an invocation; None disables caching
+        self._scheme_cache = {} if scheme_cache else None
+
+    def _open_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Reuse connections across calls instead of a new handshake per request
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=2, backoff_factor=0.1),
         )
-        self.format_response(response)
-
-    def list(self, kind, limit=100):
-        response = requests.post(
-            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery",
-            json={
-                "gqlQuery": {
-                    "queryString": f"SELECT * FROM {kind} LIMIT {limit}",
-                    "allowLiterals": True,
-                }
-            },
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def _post(self, body, stream=False):
+        return self.session.post(self._run_query_url, data=body, stream=stream)
+
+    def _run_gql(self, query_string, stream=True):
+        return self._post(gql_body(query_string), stream=stream)
+
+    def _iter_entity_results(self, response):
+        """
+        Iterate over entityResults of a streamed response without loading it whole,
+        parsing each chunk as it arrives from the socket
+        """
+        if ijson is None:
+            data = json_loads(response.content)
+            return data.get("batch", {}).get("entityResults", [])
+        response.raw.read = functools.partial(response.raw.read, decode_content=True)
+        return ijson.items(
+            response.raw,
+            "batch.entityResults.item",
+            buf_size=STREAM_CHUNK_SIZE,
+            use_float=True,
         )
-        self.format_response(response)
 
-    def _extract_query(self, text):
-        lines, opts = [], {}
-        for line in text.split("\n"):
-            if line.startswith("--"):
-                if line.startswith("-- yq:"):
-                    yq_query = line.replace("-- yq:", "").strip()
-                    opts["yq"] = yq_query
-                elif line.startswith("-- jq:"):
-                    jq_query = line.replace("-- jq:", "").strip()
-                    opts["jq"] = jq_query
+    def _query_entity_results(self, query_string):
+        with self._run_gql(query_string) as response:
+            if response.status_code != 200:
+                raise Exception("Error:", response.status_code, response.content)
+            yield from self._iter_entity_results(response)
+
+    def format_response(
+        self, response: "requests.Response", format="yaml", style="scheme"
+    ):
+        if response.status_code != 200:
+            return
+        # Raw output needs the whole body, everything else streams the entities
+        if format == "raw":
+            self._format_data((), response.content, format, style)
+        else:
+            self._format_data(self._iter_entity_results(response), b"", format, style)
+
+    def _format_data(self, entity_results, content, format="yaml", style="scheme"):
+        if format == "raw":
+            print(content.decode("utf-8"))
+        else:
+            self._dump_entities(entity_results, format, style)
+
+    def get(self, kind, id, **kwargs):
+        with self._run_gql(
+            f"SELECT * FROM {kind} WHERE __key__ HAS ANCESTOR KEY({kind}, {id})"
+        ) as response:
+            self.format_response(response, **kwargs)
+
+    def list(self, kind, limit=100, parallel=None, format="yaml", style="scheme"):
+        if parallel:
+            self._dump_entities(
+                self._list_parallel(kind, limit, parallel), format, style
+            )
+            return
+        with self._run_gql(f"SELECT * FROM {kind} LIMIT {limit}") as response:
+            self.format_response(response, format, style)
+
+    def _run_batch(self, kind, limit, offset, cursor=None):
+        if cursor is None:
+            response = self._run_gql(
+                f"SELECT * FROM {kind} LIMIT {limit} OFFSET {offset}", stream=False
+            )
+        else:
+            # Resume after the previous batch, skipping whatever is left of offset
+            position = f"@cursor + {offset}" if offset else "@cursor"
+            response = self._post(
+                json_dumps(
+                    {
+                        "gqlQuery": {
+                            "queryString": f"SELECT * FROM {kind} LIMIT {limit} "
+                            f"OFFSET {position}",
+                            "allowLiterals": True,
+                            "namedBindings": {"cursor": {"cursor": cursor}},
+                        }
+                    }
+                )
+            )
+        if response.status_code != 200:
+            raise Exception("Error:", response.status_code, response.content)
+        return json_loads(response.content).get("batch", {})
+
+    def _fetch_range(self, kind, limit, offset):
+        """
+        Fetch up to limit entities starting at offset. Datastore may end a batch
+        early, even before the offset is fully skipped, so keep following the
+        batch cursor until the range is complete. Also report whether the range
+        reached the end of the results
+        """
+        entity_results, cursor = [], None
+        while len(entity_results) < limit:
+            batch = self._run_batch(kind, limit - len(entity_results), offset, cursor)
+            results = batch.get("entityResults", [])
+            entity_results.extend(results)
+            more_results = batch.get("moreResults")
+            if more_results != "NOT_FINISHED":
+                if more_results == "NO_MORE_RESULTS":
+                    return entity_results, True
+                break
+            offset -= int(batch.get("skippedResults", 0))
+            if results:
+                cursor = batch["endCursor"]
             else:
-                lines.append(line)
-        text = "\n".join(lines)
-        return text, opts
+                cursor = batch.get("skippedCursor", batch["endCursor"])
+        return entity_results, len(entity_results) < limit
+
+    def _list_parallel(self, kind, limit, parallel):
+        """
+        Fetch up to limit entities, requesting the pages after the first
+        truncated batch concurrently by offset, at most parallel pages per wave
+        so that scheduling stops once the results run out
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from itertools import islice
+
+        batch = self._run_batch(kind, limit, 0)
+        entity_results = batch.get("entityResults", [])
+        page = len(entity_results)
+        if batch.get("moreResults") != "NOT_FINISHED" or page >= limit:
+            return entity_results
+        if page == 0:
+            return self._fetch_range(kind, limit, 0)[0]
+
+        offsets = iter(range(page, limit, page))
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            while wave := list(islice(offsets, parallel)):
+                done = False
+                for results, end in executor.map(
+                    lambda offset: self._fetch_range(
+                        kind, min(page, limit - offset), offset
+                    ),
+                    wave,
+                ):
+                    entity_results.extend(results)
+                    done = done or end
+                if done:
+                    break
+        return entity_results
 
     def query(self, text, **kwargs):
         queryString, _ = self._extract_query(text)
-        response = requests.post(
-            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery",
-            json={
-                "gqlQuery": {
-                    "queryString": queryString,
-                    "allowLiterals": True,
-                }
-            },
-        )
-        self.format_response(response, **kwargs)
+        with self._run_gql(queryString) as response:
+            self.format_response(response, **kwargs)
 
     def getKinds(self):
-        response = requests.post(
-            self.DATASTORE_HOST + f"/v1/projects/{self.DATASTORE_PROJECT_ID}:runQuery",
-            json={
-                "query": {
-                    "kind": [
-                        {"name": "__kind__"},
-                    ],
+        response = self._post(
+            json_dumps(
+                {
+                    "query": {
+                        "kind": [
+                            {"name": "__kind__"},
+                        ],
+                    }
                 }
-            },
+            )
         )
         if response.status_code == 200:
-            print(response.json())
+            print(json_loads(response.content))
 
     def test_connection(self):
-        return requests.get(self.DATASTORE_HOST).text.strip() == "Ok"
+        return self.session.get(self.DATASTORE_HOST).content.strip() == b"Ok"
 
-    @classmethod
-    def config(cls) -> dict:
-        return {
-            "DATASTORE_DATASET": cls.DATASTORE_DATASET,
-            "DATASTORE_HOST": cls.DATASTORE_HOST,
-            "DATASTORE_EMULATOR_HOST": cls.DATASTORE_EMULATOR_HOST,
-            "DATASTORE_EMULATOR_HOST_PATH": cls.DATASTORE_EMULATOR_HOST_PATH,
-            "DATASTORE_PROJECT_ID": cls.DATASTORE_PROJECT_ID,
-        }
+
+class AsyncDatastore(Datastore):
+    """
+    Datastore client that runs independent queries concurrently
+    """
+
+    __slots__ = ("async_session",)
+
+    def _open_session(self):
+        # Requests go through the aiohttp session opened in __aenter__
+        return None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self.async_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=30)
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.async_session.close()
+
+    async def _run_gql_async(self, query_string):
+        async with self.async_session.post(
+            self._run_query_url,
+            data=gql_body(query_string),
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            return response.status, await response.read()
+
+    async def _run_many(self, query_strings, **kwargs):
+        import asyncio
+
+        results = await asyncio.gather(
+            *[self._run_gql_async(qs) for qs in query_strings]
+        )
+        for status, content in results:
+            if status == 200:
+                data = json_loads(content)
+                self._format_data(
+                    data.get("batch", {}).get("entityResults", []), content, **kwargs
+                )
+
+    async def get_many(self, kind, ids, **kwargs):
+        await self._run_many(
+            [
+                f"SELECT * FROM {kind} WHERE __key__ HAS ANCESTOR KEY({kind}, {id})"
+                for id in ids
+            ],
+            **kwargs,
+        )
+
+    async def list_many(self, kinds, limit=100, **kwargs):
+        await self._run_many(
+            [f"SELECT * FROM {kind} LIMIT {limit}" for kind in kinds], **kwargs
+        )
+
+
+class DatastoreGrpc(BaseDatastore):
+    """
+    Datastore client speaking gRPC through google-cloud-datastore
+    """
+
+    __slots__ = ("client",)
+
+    def __init__(self, DATASTORE_PROJECT_ID=None, scheme_cache=True):
+        from google.cloud import datastore_v1
+
+        self.DATASTORE_PROJECT_ID = (
+            DATASTORE_PROJECT_ID or DATASTORE_CONFIG["DATASTORE_PROJECT_ID"]
+        )
+        self.client = datastore_v1.DatastoreClient()
+        self._scheme_cache = {} if scheme_cache else None
+
+    def close(self):
+        self.client.transport.close()
+
+    def _run_query(self, **query):
+        from google.protobuf.json_format import MessageToDict
+
+        response = self.client.run_query(
+            request={"project_id": self.DATASTORE_PROJECT_ID, **query}
+        )
+        # Same camelCase shape as the REST API, without a JSON round-trip
+        return MessageToDict(type(response).pb(response))
+
+    def _query_entity_results(self, query_string):
+        data = self._run_query(
+            gql_query={"query_string": query_string, "allow_literals": True}
+        )
+        return data.get("batch", {}).get("entityResults", [])
+
+    def _print_gql(self, query_string, format="yaml", style="scheme"):
+        if format == "raw":
+            print(
+                self._run_query(
+                    gql_query={"query_string": query_string, "allow_literals": True}
+                )
+            )
+        else:
+            self._dump_entities(self._query_entity_results(query_string), format, style)
+
+    def get(self, kind, id, **kwargs):
+        self._print_gql(
+            f"SELECT * FROM {kind} WHERE __key__ HAS ANCESTOR KEY({kind}, {id})",
+            **kwargs,
+        )
+
+    def list(self, kind, limit=100, **kwargs):
+        self._print_gql(f"SELECT * FROM {kind} LIMIT {limit}", **kwargs)
+
+    def query(self, text, **kwargs):
+        queryString, _ = self._extract_query(text)
+        self._print_gql(queryString, **kwargs)
+
+    def getKinds(self):
+        print(self._run_query(query={"kind": [{"name": "__kind__"}]}))
+
+    def test_connection(self):
+        from google.api_core.exceptions import GoogleAPICallError
+
+        try:
+            self._query_entity_results("SELECT __key__ FROM __kind__ LIMIT 1")
+        except GoogleAPICallError:
+            return False
+        return True
+
+
+ACTIONS = ["query", "get", "list", "put", "delete"]
+FORMATS = ["yaml", "json", "raw"]
+TRANSPORTS = ["rest", "grpc"]
+
+# Long options understood by the fast path in get_args, mapped to their dest
+_VALUE_OPTIONS = {
+    "--datastore-dataset": "datastore_dataset",
+    "--datastore-host": "datastore_host",
+    "--datastore-emulator-host": "datastore_emulator_host",
+    "--datastore-emulator-host-path": "datastore_emulator_host_path",
+    "--datastore-project-id": "datastore_project_id",
+    "--limit": "limit",
+    "--parallel": "parallel",
+    "--format": "format",
+    "--style": "style",
+    "--transport": "transport",
+}
+_FLAG_OPTIONS = {
+    "--no-scheme-cache": ("scheme_cache", False),
+}
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ValueError(value)
+    return number
 
 
 def get_args():
+    """
+    Parse sys.argv without importing argparse; help and anything unexpected
+    fall back to the full argparse parser for its messages
+    """
+    values = {
+        "datastore_dataset": DATASTORE_CONFIG["DATASTORE_DATASET"],
+        "datastore_host": DATASTORE_CONFIG["DATASTORE_HOST"],
+        "datastore_emulator_host": DATASTORE_CONFIG["DATASTORE_EMULATOR_HOST"],
+        "datastore_emulator_host_path": DATASTORE_CONFIG[
+            "DATASTORE_EMULATOR_HOST_PATH"
+        ],
+        "datastore_project_id": DATASTORE_CONFIG["DATASTORE_PROJECT_ID"],
+        "limit": 100,
+        "parallel": None,
+        "format": "yaml",
+        "style": "scheme",
+        "transport": "rest",
+        "scheme_cache": True,
+    }
+    positionals = []
+
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg == "--":
+            positionals.extend(argv[i:])
+            break
+        if arg.startswith("--"):
+            name, sep, value = arg.partition("=")
+            if name in _FLAG_OPTIONS and not sep:
+                dest, flag = _FLAG_OPTIONS[name]
+                values[dest] = flag
+            elif name in _VALUE_OPTIONS and (sep or i < len(argv)):
+                if not sep:
+                    value = argv[i]
+                    i += 1
+                values[_VALUE_OPTIONS[name]] = value
+            else:
+                return parse_args_slow()
+        elif arg.startswith("-") and arg != "-":
+            return parse_args_slow()
+        else:
+            positionals.append(arg)
+
+    if not positionals or positionals[0] not in ACTIONS:
+        return parse_args_slow()
+    if values["format"] not in FORMATS or values["transport"] not in TRANSPORTS:
+        return parse_args_slow()
+    try:
+        values["limit"] = positive_int(values["limit"])
+        if values["parallel"] is not None:
+            values["parallel"] = positive_int(values["parallel"])
+    except ValueError:
+        return parse_args_slow()
+
+    return SimpleNamespace(action=positionals[0], content=positionals[1:], **values)
+
+
+def parse_args_slow():
+    return build_parser().parse_args()
+
+
+def build_parser():
+    import argparse
+
     parser = argparse.ArgumentParser(description="CLI for datastore")
 
     parser.add_argument(
         "action",
         help="Action to perform",
-        choices=["query", "get", "list", "put", "delete"],
+        choices=ACTIONS,
     )
 
     parser.add_argument(
         "content",
         help="Content to perform the action on",
-        nargs="?",
-    )
-
-    parser.add_argument(
-        "subcontent",
-        help="Subcontent to perform the action on",
-        nargs="?",
+        nargs="*",
     )
 
     parser.add_argument(
         "--datastore-dataset",
         help="Dataset of the datastore",
-        default=Datastore.DATASTORE_DATASET,
+        default=DATASTORE_CONFIG["DATASTORE_DATASET"],
         required=False,
     )
     parser.add_argument(
         "--datastore-host",
         help="Host of the datastore",
-        default=Datastore.DATASTORE_HOST,
+        default=DATASTORE_CONFIG["DATASTORE_HOST"],
         required=False,
     )
     parser.add_argument(
         "--datastore-emulator-host",
         help="Host of the emulator",
-        default=Datastore.DATASTORE_EMULATOR_HOST,
+        default=DATASTORE_CONFIG["DATASTORE_EMULATOR_HOST"],
         required=False,
     )
     parser.add_argument(
         "--datastore-emulator-host-path",
         help="Path of the emulator",
-        default=Datastore.DATASTORE_EMULATOR_HOST_PATH,
+        default=DATASTORE_CONFIG["DATASTORE_EMULATOR_HOST_PATH"],
         required=False,
     )
     parser.add_argument(
         "--datastore-project-id",
         help="Project ID",
-        default=Datastore.DATASTORE_PROJECT_ID,
+        default=DATASTORE_CONFIG["DATASTORE_PROJECT_ID"],
         required=False,
     )
 
     parser.add_argument(
         "--limit",
         help="Limit of the query",
+        type=positive_int,
         default=100,
         required=False,
     )
+    parser.add_argument(
+        "--parallel",
+        help="Fetch pages of a list concurrently with this many workers",
+        type=positive_int,
+        default=None,
+        required=False,
+    )
     parser.add_argument(
         "--format",
         help="Format of the output",
-        action="store_true",
+        choices=FORMATS,
         default="yaml",
         required=False,
     )
     parser.add_argument(
         "--style",
         help="Style of the output",
-        action="store_true",
         default="scheme",
         required=False,
     )
+    parser.add_argument(
+        "--transport",
+        help="Protocol used to talk to the datastore",
+        choices=TRANSPORTS,
+        default="rest",
+        required=False,
+    )
+    parser.add_argument(
+        "--no-scheme-cache",
+        help="Always fetch the scheme from the datastore",
+        dest="scheme_cache",
+        action="store_false",
+    )
 
-    args = parser.parse_args()
-    return args
+    return parser
 
 
-def main():
-    args = get_args()
-    client = Datastore()
+def check_args(args):
+    if args.action == "get" and len(args.content) < 2:
+        build_parser().error("get requires a kind and at least one id")
+    if args.action == "list" and not args.content:
+        build_parser().error("list requires a kind")
+    if args.parallel is not None and args.transport == "grpc":
+        build_parser().error("--parallel is only supported with --transport=rest")
+    if args.format == "raw" and args.parallel is not None:
+        build_parser().error("--format=raw cannot be combined with --parallel")
+    if args.format == "raw" and args.action == "get" and args.content[1:] == ["scheme"]:
+        build_parser().error("--format=raw is not available for schemes")
 
-    if args.action == "query":
-        if args.content == "-" or args.content is None:
-            client.query(sys.stdin.read(), format=args.format, style=args.style)
-        else:
-            client.query(args.content, format=args.format, style=args.style)
-    elif args.action == "get":
-        kind = args.content
-        id = args.subcontent
-        if id == "scheme":
-            print(yaml.dump(client.get_scheme(kind)))
-        else:
-            client.get(kind, id)
-    elif args.action == "list":
-        if args.content == "kinds":
-            client.getKinds()
+
+async def run_concurrently(args):
+    async with AsyncDatastore(scheme_cache=args.scheme_cache) as client:
+        if args.action == "get":
+            kind, *ids = args.content
+            await client.get_many(kind, ids, format=args.format, style=args.style)
         else:
-            client.list(args.content, args.limit)
+            await client.list_many(
+                args.content, args.limit, format=args.format, style=args.style
+            )
+
+
+def main() -> None:
+    args = get_args()
+    check_args(args)
+
+    # The async client batches over REST; gRPC multiplexes on one channel anyway
+    # With --parallel each listed kind is paged on the sync client instead
+    if HAS_AIOHTTP and args.transport == "rest":
+        if (args.action == "get" and len(args.content) > 2) or (
+            args.action == "list" and len(args.content) > 1 and args.parallel is None
+        ):
+            import asyncio
+
+            asyncio.run(run_concurrently(args))
+            return
+
+    client_class: Callable[..., Database] = (
+        DatastoreGrpc if args.transport == "grpc" else Datastore
+    )
+    client: Database
+    with client_class(scheme_cache=args.scheme_cache) as client:
+        if args.action == "query":
+            if args.content in ([], ["-"]):
+                client.query(
+                    sys.stdin.buffer.read().decode("utf-8"),
+                    format=args.format,
+                    style=args.style,
+                )
+            else:
+                client.query(
+                    " ".join(args.content), format=args.format, style=args.style
+                )
+        elif args.action == "get":
+            kind, *ids = args.content
+            if ids == ["scheme"]:
+                scheme = client.get_scheme(kind)
+                if args.format == "json":
+                    write_stdout(json_dumps_pretty(scheme), b"\n")
+                else:
+                    dump_yaml(scheme)
+            else:
+                for id in ids:
+                    client.get(kind, id, format=args.format, style=args.style)
+        elif args.action == "list":
+            if args.content == ["kinds"]:
+                client.getKinds()
+            else:
+                kwargs = {"format": args.format, "style": args.style}
+                if args.parallel:
+                    kwargs["parallel"] = args.parallel
+                for kind in args.content:
+                    client.list(kind, args.limit, **kwargs)
 
 
 if __name__ == "__main__":